@@ -86,10 +86,8 @@ def get_hyp_config():
     gbtree_hyp, dart_hyp = xgb_hyp()
     space = hp.choice('booster', [gbtree_hyp, {**gbtree_hyp, **dart_hyp}])
     params = hyperopt.pyll.stochastic.sample(space)
-    for k, v in params.items():
-        if type(v) == float and int(v) == v:
-            params[k] = int(v)
-    params = {k: v for k, v in params.items() if v is not 'default'}
+    params = {k: (int(v) if isinstance(v, float) and v.is_integer() else v)
+              for k, v in params.items() if v != 'default'}
     return params
 
 
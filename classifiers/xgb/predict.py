@@ -11,6 +11,7 @@ import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
+plt.rcParams['pdf.compression'] = 9
 from scipy.special import logit
 
 
@@ -21,6 +22,10 @@ def plot_ROC_curve(y_true, y_pred, meta = ''):
     fpr, tpr, thresholds = roc_curve(y_true, y_pred)
     roc_auc = auc(fpr, tpr)
 
+    # Plot at most ~2048 points, the PDF is vector output anyway
+    stride = max(1, len(fpr)//2048)
+    fpr, tpr = np.append(fpr[::stride], fpr[-1]), np.append(tpr[::stride], tpr[-1])
+
     print('Plotting AUC')
     print('AUC: {}'.format(roc_auc))
     plt.figure()
@@ -35,7 +40,7 @@ def plot_ROC_curve(y_true, y_pred, meta = ''):
     plt.xlabel(r'False Positive Rate')
     plt.ylabel(r'True Positive Rate')
     plt.legend(loc="lower right")
-    plt.savefig(os.path.join('graphs', 'val_{}'.format(args.id) + 'ROC.pdf'), format='pdf', dpi=1000)
+    plt.savefig(os.path.join('graphs', 'val_{}'.format(args.id) + 'ROC.pdf'), format='pdf', dpi=150, bbox_inches='tight')
     plt.gcf().clear()
 
     print('Plotting signal efficiency versus background rejection')
@@ -50,7 +55,7 @@ def plot_ROC_curve(y_true, y_pred, meta = ''):
     plt.xlabel(r'$\epsilon_S$')
     plt.ylabel(r'$1-\epsilon_B$')
     plt.legend(loc="upper right")
-    plt.savefig(os.path.join('graphs', 'val_{}'.format(args.id) + 'SEvBR.pdf'), format='pdf', dpi=1000)
+    plt.savefig(os.path.join('graphs', 'val_{}'.format(args.id) + 'SEvBR.pdf'), format='pdf', dpi=150, bbox_inches='tight')
     plt.gcf().clear()
 
 def load_data(df_fname, identifier):
@@ -101,12 +106,10 @@ def plot_fit_variables(df_sig, df_bkg, identifier, nbins = 50, columns=['mbc', '
 
 def plot_importances(bst):
     print('Plotting variable importances')
-    importances = bst.get_fscore()
-    df_importance = pd.DataFrame({'Importance': list(importances.values()), 'Feature': list(importances.keys())})
-    df_importance.sort_values(by = 'Importance', inplace = True)
-    df_importance[-20:].plot(kind = 'barh', x = 'Feature', color = 'orange', figsize = (15,15),
-                                     title = 'Feature Importances')
-    plt.savefig(os.path.join('graphs', 'val_{}'.format(args.id) + 'xgb_rankings.pdf'), format='pdf', dpi=1000)
+    # Top 20 features, ascending so the most important is drawn at the top
+    importances = pd.Series(bst.get_fscore()).nlargest(20).sort_values()
+    importances.plot(kind = 'barh', color = 'orange', figsize = (15,15), title = 'Feature Importances')
+    plt.savefig(os.path.join('graphs', 'val_{}'.format(args.id) + 'xgb_rankings.pdf'), format='pdf', dpi=150, bbox_inches='tight')
 
 def normalize_weights(x):
     # Weights to normalize output histograms
@@ -106,10 +106,8 @@ def get_hyp_config():
     gbtree_hyp, dart_hyp = xgb_hyp()
     space = hp.choice('booster', [gbtree_hyp, {**gbtree_hyp, **dart_hyp}])
     params = hyperopt.pyll.stochastic.sample(space)
-    for k, v in params.items():
-        if type(v) == float and int(v) == v:
-            params[k] = int(v)
-    params = {k: v for k, v in params.items() if v is not 'default'}
+    params = {k: (int(v) if isinstance(v, float) and v.is_integer() else v)
+              for k, v in params.items() if v != 'default'}
     return params
 
 
@@ -133,12 +131,10 @@ def save_results(results):
     print('Boosting complete. Model saved to {}'.format(output))
 
 def plot_importances(bst):
-    importances = bst.get_fscore()
-    df_importance = pd.DataFrame({'Importance': list(importances.values()), 'Feature': list(importances.keys())})
-    df_importance.sort_values(by = 'Importance', inplace = True)
-    df_importance[-20:].plot(kind = 'barh', x = 'Feature', color = 'orange', figsize = (15,15),
-                                     title = 'Feature Importances')
-    plt.savefig(os.path.join('graphs', 'pi0veto' + 'xgb_importances.pdf'), format='pdf', dpi=1000)
+    # Top 20 features, ascending so the most important is drawn at the top
+    importances = pd.Series(bst.get_fscore()).nlargest(20).sort_values()
+    importances.plot(kind = 'barh', color = 'orange', figsize = (15,15), title = 'Feature Importances')
+    plt.savefig(os.path.join('graphs', 'pi0veto' + 'xgb_importances.pdf'), format='pdf', dpi=150, bbox_inches='tight')
 
 def plot_ROC_curve(y_true, y_pred, meta = ''):
     from sklearn.metrics import roc_curve, auc
@@ -147,6 +143,10 @@ def plot_ROC_curve(y_true, y_pred, meta = ''):
     fpr, tpr, thresholds = roc_curve(y_true, y_pred)
     roc_auc = auc(fpr, tpr)
 
+    # Plot at most ~2048 points, the PDF is vector output anyway
+    stride = max(1, len(fpr)//2048)
+    fpr, tpr = np.append(fpr[::stride], fpr[-1]), np.append(tpr[::stride], tpr[-1])
+
     plt.figure()
     plt.axes([.1,.1,.8,.7])
     plt.figtext(.5,.9, r'$\mathrm{Receiver \;Operating \;Characteristic}$', fontsize=15, ha='center')
@@ -159,7 +159,7 @@ def plot_ROC_curve(y_true, y_pred, meta = ''):
     plt.xlabel(r'$\mathrm{False \;Positive \;Rate}$')
     plt.ylabel(r'$\mathrm{True \;Positive \;Rate}$')
     plt.legend(loc="lower right")
-    plt.savefig(os.path.join('graphs', 'pi0veto_ROC.pdf'), format='pdf', dpi=1000)
+    plt.savefig(os.path.join('graphs', 'pi0veto_ROC.pdf'), format='pdf', dpi=150, bbox_inches='tight')
     plt.gcf().clear()
 
 def diagnostics(dTest, bst, hp):
@@ -167,12 +167,13 @@ def diagnostics(dTest, bst, hp):
     mpl.use('Agg')
     import matplotlib.pyplot as plt
     import seaborn as sns
+    plt.rcParams['pdf.compression'] = 9
     xgb_pred = bst.predict(dTest)
-    y_pred = np.greater(xgb_pred, 0.5)
     y_true = dTest.get_label()
     #y_true = df_y_test.values
 
-    test_accuracy = np.equal(y_pred, y_true).mean()
+    # Threshold and compare in one expression - single boolean temporary
+    test_accuracy = np.mean((xgb_pred > 0.5) == y_true)
     print('Test accuracy: {}'.format(test_accuracy))
 
     plot_ROC_curve(y_true = y_true, y_pred = xgb_pred,
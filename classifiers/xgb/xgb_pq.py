@@ -2,10 +2,17 @@
 # XGBoost training script
 # Optional arguments: randomly select hyperparameters
 
+import os
+if __name__ == '__main__':
+    # Bind OpenMP threads to physical cores. Read once when XGBoost loads the
+    # OpenMP runtime, so this has to precede the imports below
+    os.environ.setdefault('OMP_PROC_BIND', 'close')
+    os.environ.setdefault('OMP_PLACES', 'cores')
+
 import numpy as np
 import pandas as pd
 import xgboost as xgb
-import sys, time, os, json
+import sys, time, json
 import argparse
 import pyarrow.parquet as pq
 
@@ -17,6 +24,35 @@ import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
+plt.rcParams['pdf.compression'] = 9
+
+# Non-training columns: labels, fit variables and event bookkeeping
+excludeFeatures = ['labels', 'mbc', 'deltae', 'nCands', 'evtNum', 'MCtype', 'channel']
+
+def physical_cores():
+    # Hyperthreads share L1/L2 and slow down the histogram build
+    try:
+        import psutil
+        return psutil.cpu_count(logical=False) or os.cpu_count()
+    except ImportError:
+        return os.cpu_count()
+
+def gpu_available():
+    # Probe for a CUDA device to offload histogram construction to
+    try:
+        import cupy
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except Exception:
+        return False
+
+def tree_method_config():
+    # Histogram split finding - on the GPU if available, CPU hist otherwise
+    if not gpu_available():
+        return {'tree_method': 'hist'}
+    if int(xgb.__version__.split('.')[0]) >= 2:
+        # XGBoost >= 2.0 selects the GPU through 'device', gpu_hist is deprecated
+        return {'tree_method': 'hist', 'device': 'cuda'}
+    return {'tree_method': 'gpu_hist', 'predictor': 'gpu_predictor'}
 
 def xgb_hyp():
     gbtree_hyp = {
@@ -28,7 +64,9 @@ def xgb_hyp():
         'subsample': hp.uniform('ss', 0.7, 1),
         'colsample_bytree': hp.uniform('cs', 0.7, 1),
         'objective': 'binary:logistic',
-        'silent': 1
+        'silent': 1,
+        'nthread': physical_cores(),
+        **tree_method_config()
     }
 
     dart_hyp = {
@@ -46,12 +84,13 @@ def hp_default_config(deep):
         print('Using deep hp config')
         hp = {'eta': 0.1, 'seed':0, 'subsample': 0.75, 'colsample_bytree': 0.85,
         'gamma': 2.5, 'objective': 'binary:logistic', 'max_depth':8,
-        'min_child_weight':0.4, 'silent':1}
+        'min_child_weight':0.4, 'silent':1, 'nthread': physical_cores()}
     else:
         hp = {'eta': 0.1, 'seed':0, 'subsample': 0.8, 'colsample_bytree': 0.9,
         'gamma': 1.6, 'objective': 'binary:logistic', 'max_depth':6,
-        'min_child_weight':1, 'silent':1}
+        'min_child_weight':1, 'silent':1, 'nthread': physical_cores()}
 
+    hp.update(tree_method_config())
     return hp
 
 
@@ -60,43 +99,166 @@ def balanced_sample(df, uspl=True, seed=42):
     lsz = [f.shape[0] for f in features_l]
     return pd.concat([f.sample(n = (min(lsz) if uspl else max(lsz)), replace = (not uspl)).copy() for f in features_l], axis=0 ).sample(frac=1, random_state=seed) 
 
+def dmatrix_cache_paths(datasetName, ident, test_size, parquet, balance):
+    # Binary buffer paths, keyed on the inputs that determine the train/test split
+    import hashlib
+    key = repr((os.path.abspath(datasetName), os.path.getmtime(datasetName), test_size, parquet, balance))
+    digest = hashlib.md5(key.encode()).hexdigest()[:10]
+    return [os.path.join('dmatrices', '{}_{}_{}.{}'.format(prefix, ident, digest, ext))
+            for prefix, ext in [('dTrain', 'buffer'), ('dTest', 'buffer'), ('yTest', 'npy'), ('xTest', 'npy'), ('split', 'npz')]]
+
+def hdf_training_columns(fname):
+    # Feature and label columns of an HDF5 dataset, read from the table schema only
+    columns = pd.read_hdf(fname, 'df', start=0, stop=0).columns
+    return [c for c in columns if c not in excludeFeatures] + ['labels']
+
+def split_indices(n_rows, split_path, test_size):
+    # Train/test row positions, persisted so repeat runs skip the shuffle
+    if os.path.exists(split_path):
+        with np.load(split_path) as split:
+            train_idx, test_idx = split['train'], split['test']
+        if train_idx.size + test_idx.size == n_rows:
+            return train_idx, test_idx
+
+    from sklearn.model_selection import train_test_split
+    train_idx, test_idx = train_test_split(np.arange(n_rows), test_size = test_size, random_state=42)
+    np.savez(split_path, train = train_idx, test = test_idx)
+    return train_idx, test_idx
+
 def load_data(datasetName, ident, test_size=0.05, parquet=False, balance=False):
     
     """
     Read dataset as parquet or HDF5 format, splits into train, test sets
+    Reuses saved DMatrix buffers from a previous run on identical inputs
+    Returns: train, test DMatrix, float32 test features for inplace prediction
+    and test labels for diagnostics
     """
-    from sklearn.model_selection import train_test_split
-    excludeFeatures = ['labels', 'mbc', 'deltae', 'nCands', 'evtNum', 'MCtype', 'channel']
+    train_path, test_path, labels_path, features_path, split_path = dmatrix_cache_paths(datasetName, ident, test_size, parquet, balance)
+    if all(os.path.exists(path) for path in [train_path, test_path, labels_path, features_path]):
+        print('Loading cached DMatrix buffers: {}, {}'.format(train_path, test_path))
+        return (xgb.DMatrix(train_path), xgb.DMatrix(test_path), np.load(features_path, mmap_mode='r'),
+                np.load(labels_path, mmap_mode='r'))
+
     if parquet:
+        # Multithreaded read of the training columns only
         dataset = pq.ParquetDataset(datasetName)
-        pdf = dataset.read(nthreads=4).to_pandas()
+        columns = [c for c in dataset.schema.names if c not in excludeFeatures] + ['labels']
+        pdf = dataset.read(columns=columns, use_threads=True).to_pandas()
         pdf = balanced_sample(pdf) if balance else pdf.sample(frac=1)
     else:
-        pdf = pd.read_hdf(datasetName, key='df')
+        with pd.HDFStore(datasetName, mode='r') as store:
+            is_table = store.get_storer('df').is_table
+        if is_table:
+            # Skip fit variables and bookkeeping columns at read time
+            pdf = pd.read_hdf(datasetName, key='df', columns=hdf_training_columns(datasetName))
+        else:
+            # Fixed format stores must be read in their entirety, select columns in memory
+            pdf = pd.read_hdf(datasetName, key='df')
+            pdf = pdf[[c for c in pdf.columns if c not in excludeFeatures] + ['labels']]
 
     # Split data into training, testing sets
-    df_X_train, df_X_test, df_y_train, df_y_test = train_test_split(pdf.drop(excludeFeatures, axis = 1), pdf['labels'], test_size = test_size, random_state=42)
-
-    dTrain = xgb.DMatrix(data = df_X_train, label = df_y_train, feature_names=df_X_train.columns.tolist())
-    dTest = xgb.DMatrix(data = df_X_test, label = df_y_test, feature_names=df_X_train.columns.tolist())
+    train_idx, test_idx = split_indices(pdf.shape[0], split_path, test_size)
+
+    # Single float32 conversion of the frame, then one gather per split -
+    # fancy indexing yields C-contiguous arrays, avoiding an upcast copy inside XGBoost
+    arr = pdf.to_numpy(dtype=np.float32)
+    label_col = pdf.columns.get_loc('labels')
+    feature_cols = [i for i, c in enumerate(pdf.columns) if c not in excludeFeatures]
+    feature_names = pdf.columns[feature_cols].tolist()
+    X_train, X_test = arr[np.ix_(train_idx, feature_cols)], arr[np.ix_(test_idx, feature_cols)]
+    y_train, y_test = arr[train_idx, label_col], arr[test_idx, label_col]
+    del pdf, arr
+
+    dTrain = xgb.DMatrix(data = X_train, label = y_train, feature_names=feature_names)
+    dTest = xgb.DMatrix(data = X_test, label = y_test, feature_names=feature_names)
     print('fNames: {}'.format(dTrain.feature_names))
 
     print('# Features: {} | # Train Samples: {} | # Test Samples: {}'.format(dTrain.num_col(),
      dTrain.num_row(), dTest.num_row()))
 
-    # Save to XGBoost binary file for faster loading
-    dTrain.save_binary(os.path.join('dmatrices', "dTrain_{}.buffer".format(ident)))
-    dTest.save_binary(os.path.join('dmatrices', "dTest_{}.buffer".format(ident)))
+    # Save to XGBoost binary file for faster loading, test labels kept for diagnostics
+    dTrain.save_binary(train_path)
+    dTest.save_binary(test_path)
+    np.save(labels_path, y_test)
+    np.save(features_path, X_test)
 
-    return dTrain, dTest
+    return dTrain, dTest, X_test, y_test
 
+class HDFIter(xgb.DataIter):
+    """
+    Streams an HDF5 dataset (table format) to XGBoost in row chunks,
+    keeping only the rows whose positions are listed in indices
+    """
+    def __init__(self, fname, indices, n_rows, chunk_size=2**18):
+        self.fname = fname
+        self.indices = np.sort(indices)
+        self.n_rows = n_rows
+        self.chunk_size = chunk_size
+        self._start = 0
+        self.columns = hdf_training_columns(fname)
+        super().__init__()
+
+    def next(self, input_data):
+        while self._start < self.n_rows:
+            start, stop = self._start, min(self._start + self.chunk_size, self.n_rows)
+            self._start = stop
+            # Positions of the selected rows falling inside this chunk
+            lo, hi = np.searchsorted(self.indices, [start, stop])
+            if lo == hi:
+                continue
+            df = pd.read_hdf(self.fname, 'df', start=start, stop=stop, columns=self.columns).iloc[self.indices[lo:hi] - start]
+            input_data(data = df.drop('labels', axis = 1).astype(np.float32),
+                       label = df['labels'].values.astype(np.float32))
+            return 1
+        return 0
+
+    def reset(self):
+        self._start = 0
+
+def load_data_streaming(fname, test_size=0.05, max_bin=256):
+    """
+    Quantizes HDF5 dataset chunk-by-chunk into QuantileDMatrix train, test
+    sets without holding the full dataset in memory
+    """
+    from sklearn.model_selection import train_test_split
+    with pd.HDFStore(fname, mode='r') as store:
+        n_rows = store.get_storer('df').nrows
 
-def train_hyp_config(data_train, data_test, hyp_params, num_boost_rounds, identifier):
+    # Split row positions once, chunks are filtered against these
+    train_idx, test_idx = train_test_split(np.arange(n_rows), test_size = test_size, random_state=42)
+
+    dTrain = xgb.QuantileDMatrix(HDFIter(fname, train_idx, n_rows), max_bin = max_bin)
+    # Test set must share the quantile cuts of the training set
+    dTest = xgb.QuantileDMatrix(HDFIter(fname, test_idx, n_rows), max_bin = max_bin, ref = dTrain)
+
+    print('# Features: {} | # Train Samples: {} | # Test Samples: {}'.format(dTrain.num_col(),
+     dTrain.num_row(), dTest.num_row()))
+
+    # Raw test features and labels are never materialized in streaming mode
+    return dTrain, dTest, None, None
+
+
+def predict_test(bst, dTest, best_iteration, X_test = None):
+    # Predictions up to best_iteration; on the GPU, predict in place on a device
+    # copy of the raw features rather than going through the DMatrix. Device
+    # predictions are returned as a cupy array for on-device metrics
+    iteration_range = (0, best_iteration+1)
+    if X_test is not None and gpu_available():
+        import cupy as cp
+        return bst.inplace_predict(cp.asarray(X_test), iteration_range = iteration_range)
+    return bst.predict(dTest, iteration_range = iteration_range)
+
+def train_hyp_config(data_train, data_test, hyp_params, num_boost_rounds, identifier, X_test = None,
+                     early_stopping_rounds = 256, callbacks = None):
     # Returns validation metric after training configuration for allocated resources
     # Inputs: data - DMatrix tuple: (train, test)
+    # callbacks - e.g. pruning callback stopping unpromising configurations early
+
+    # Select tree construction algorithm if not already specified
+    for k, v in tree_method_config().items():
+        hyp_params.setdefault(k, v)
 
-    # Add evaluation metrics for validation set
-    hyp_params['eval_metric'] = 'error@0.5'
+    # Watch AUC only - each extra metric costs a full pass over the eval set per round
     pList = list(hyp_params.items())+[('eval_metric', 'auc')]
 
     # Number of boosted trees to construct
@@ -109,19 +271,25 @@ def train_hyp_config(data_train, data_test, hyp_params, num_boost_rounds, identi
     start_time = time.time()
     # Train the model using the above parameters
     bst = xgb.train(params = pList, dtrain = dTrain, evals = evalList, num_boost_round = nTrees,
-                    early_stopping_rounds = 256, verbose_eval = 25)
+                    early_stopping_rounds = early_stopping_rounds, verbose_eval = 25, callbacks = callbacks)
 
     delta_t = time.time() - start_time
     print("Training ended. Elapsed time: (%.3f s)." %(delta_t))
     pprint(bst.attributes())
 
-    evalDict = {'auc': float(bst.attr('best_score')), 'error@0.5': bst.attr('best_msg').split('\t')[-2],
-                'best_iteration': int(bst.attr('best_iteration'))}
+    # Test predictions at the best iteration, computed once post-training and
+    # shared with diagnostics
+    best_iteration = int(bst.attr('best_iteration'))
+    test_pred = predict_test(bst, dTest, best_iteration, X_test)
+    test_error = 1 - accuracy(test_pred, dTest.get_label())
+
+    evalDict = {'auc': float(bst.attr('best_score')), 'error@0.5': test_error,
+                'best_iteration': best_iteration}
 
     model_output = os.path.join('models', '{}.model'.format(identifier))
     bst.save_model(model_output)
 
-    return bst, evalDict
+    return bst, evalDict, test_pred
 
 
 def get_hyp_config():
@@ -129,10 +297,12 @@ def get_hyp_config():
     gbtree_hyp, dart_hyp = xgb_hyp()
     space = hp.choice('booster', [gbtree_hyp, {**gbtree_hyp, **dart_hyp}])
     params = hyperopt.pyll.stochastic.sample(space)
-    for k, v in params.items():
-        if type(v) == float and int(v) == v:
-            params[k] = int(v)
-    params = {k: v for k, v in params.items() if v is not 'default'}
+    return clean_hyp_config(params)
+
+def clean_hyp_config(params):
+    # Cast integral samples (e.g. quniform max_depth) to int, drop unset parameters
+    params = {k: (int(v) if isinstance(v, float) and v.is_integer() else v)
+              for k, v in params.items() if v != 'default'}
     return params
 
 
@@ -147,28 +317,151 @@ def run_hyp_config(data, hyp_params, n_iterations, rounds_per_iteration = 64):
 
     return train_hyp_config(data, hyp_params, num_boost_rounds)
 
+def spark_task_gpu():
+    # GPU address assigned to the current Spark task, None outside Spark or without GPU scheduling
+    try:
+        from pyspark import TaskContext
+    except ImportError:
+        return None
+    context = TaskContext.get()
+    if context is None or 'gpu' not in context.resources():
+        return None
+    return context.resources()['gpu'].addresses[0]
+
+def hyperopt_search(train_path, test_path, num_boost_rounds, identifier, max_evals, parallelism=1, fixed_params=None):
+    """
+    TPE search over xgb_hyp() space, evaluating up to <parallelism> configurations
+    concurrently on Spark workers. Trials load the saved DMatrix buffers
+    independently, as DMatrix handles cannot be shipped to workers
+    Returns: list of per-trial results, best first
+    """
+    import uuid
+    from hyperopt import fmin, tpe, STATUS_OK, Trials
+    fixed_params = fixed_params or {}
+
+    gbtree_hyp, dart_hyp = xgb_hyp()
+    space = hp.choice('booster', [gbtree_hyp, {**gbtree_hyp, **dart_hyp}])
+
+    def objective(sample):
+        hyp_params = {**clean_hyp_config(sample), **fixed_params}
+        # Pin this trial to the GPU Spark scheduled its task on. Set per trial in the
+        # params, as CUDA_VISIBLE_DEVICES is ignored by an already initialized (reused) worker
+        gpu = spark_task_gpu()
+        if gpu is not None:
+            if int(xgb.__version__.split('.')[0]) >= 2:
+                hyp_params['device'] = 'cuda:{}'.format(gpu)
+            else:
+                hyp_params['gpu_id'] = int(gpu)
+        dTrain, dTest = xgb.DMatrix(train_path), xgb.DMatrix(test_path)
+        # Unique model name per trial, concurrent trials would otherwise overwrite each other
+        trial_id = '{}_{}'.format(identifier, uuid.uuid4().hex[:8])
+        _, evalDict, _ = train_hyp_config(dTrain, dTest, hyp_params, num_boost_rounds, trial_id)
+        return {'loss': -evalDict['auc'], 'status': STATUS_OK, 'params': hyp_params, 'model': trial_id, **evalDict}
+
+    if parallelism > 1:
+        from hyperopt import SparkTrials
+        trials = SparkTrials(parallelism = parallelism)
+    else:
+        trials = Trials()
+
+    fmin(objective, space, algo = tpe.suggest, max_evals = max_evals, trials = trials)
+
+    return sorted(trials.results, key = lambda r: r['loss'])
+
+def asha_search(train_path, test_path, num_boost_rounds, identifier, max_evals, parallelism=1, fixed_params=None,
+                grace_period=32, reduction_factor=3):
+    """
+    Random search over xgb_hyp() space with asynchronous successive halving:
+    at rungs of grace_period*reduction_factor^k boosting rounds, trials outside
+    the top 1/reduction_factor by eval AUC are stopped. <parallelism> trials
+    run concurrently in threads
+    Returns: list of results for trials run to completion, best first
+    """
+    import optuna
+    from optuna.integration import XGBoostPruningCallback
+    fixed_params = fixed_params or {}
+
+    pruner = optuna.pruners.SuccessiveHalvingPruner(min_resource = grace_period, reduction_factor = reduction_factor)
+    study = optuna.create_study(direction = 'maximize', pruner = pruner)
+
+    def objective(trial):
+        # Configurations drawn i.i.d. as in Hyperband, Optuna only schedules the pruning
+        hyp_params = {**get_hyp_config(), **fixed_params}
+        if parallelism > 1:
+            # Concurrent trials share the process, split the physical cores between them
+            hyp_params['nthread'] = max(1, physical_cores() // parallelism)
+        trial.set_user_attr('params', hyp_params)
+        dTrain, dTest = xgb.DMatrix(train_path), xgb.DMatrix(test_path)
+        trial_id = '{}_{}'.format(identifier, trial.number)
+        _, evalDict, _ = train_hyp_config(dTrain, dTest, hyp_params, num_boost_rounds, trial_id,
+                                          callbacks = [XGBoostPruningCallback(trial, 'eval-auc')])
+        trial.set_user_attr('result', {'params': hyp_params, 'model': trial_id, **evalDict})
+        return evalDict['auc']
+
+    study.optimize(objective, n_trials = max_evals, n_jobs = parallelism)
+
+    completed = [t for t in study.trials if t.state == optuna.trial.TrialState.COMPLETE]
+    print('ASHA: {} of {} trials pruned'.format(len(study.trials) - len(completed), len(study.trials)))
+
+    return [t.user_attrs['result'] for t in sorted(completed, key = lambda t: -t.value)]
+
 def save_results(results):
     # Save dictionary of results to json
     timestamp = time.strftime("%b_%d_%H:%M")
     output = os.path.join('models', args.id + timestamp + '.json')
-    with open(output, 'w') as f:
-        json.dump(results, f)
+    try:
+        import orjson
+        # Serializes numpy scalars/arrays natively, writes bytes directly
+        with open(output, 'wb') as f:
+            f.write(orjson.dumps(results, option = orjson.OPT_SERIALIZE_NUMPY))
+    except ImportError:
+        with open(output, 'w') as f:
+            json.dump(results, f, default = float)
     print('Boosting complete. Model saved to {}'.format(output))
 
 def plot_importances(bst):
-    importances = bst.get_fscore()
-    df_importance = pd.DataFrame({'Importance': list(importances.values()), 'Feature': list(importances.keys())})
-    df_importance.sort_values(by = 'Importance', inplace = True)
-    df_importance[-20:].plot(kind = 'barh', x = 'Feature', color = 'orange', figsize = (15,15),
-                                     title = 'Feature Importances')
-    plt.savefig(os.path.join('graphs', args.id + 'xgb_importances.pdf'), format='pdf', dpi=1000)
+    # Top 20 features, ascending so the most important is drawn at the top
+    importances = pd.Series(bst.get_fscore()).nlargest(20).sort_values()
+    importances.plot(kind = 'barh', color = 'orange', figsize = (15,15), title = 'Feature Importances')
+    plt.savefig(os.path.join('graphs', args.id + 'xgb_importances.pdf'), format='pdf', dpi=150, bbox_inches='tight')
 
-def plot_ROC_curve(y_true, y_pred, meta = ''):
-    from sklearn.metrics import roc_curve, auc
+def roc_curve_points(y_true, y_prob, max_points = 2048):
+    """
+    ROC curve and AUC from a single sort over predictions. Device (cupy)
+    predictions are processed on the GPU, only the thinned curve is copied back
+    Returns: fpr, tpr (host arrays of at most ~max_points), AUC
+    """
+    if isinstance(y_prob, np.ndarray):
+        from sklearn.metrics import roc_curve, auc
+        host = np.asarray
+        # Compute ROC curve (the only sort over predictions), integrate the
+        # already monotone curve in O(N) rather than calling roc_auc_score
+        fpr, tpr, thresholds = roc_curve(y_true, y_prob, drop_intermediate = True)
+        roc_auc = auc(fpr, tpr)
+    else:
+        import cupy as cp
+        host = cp.asnumpy
+        order = cp.argsort(-y_prob)
+        y_prob, y_true = y_prob[order], cp.asarray(y_true)[order]
+        # One curve point per distinct score - tied predictions share a threshold
+        idx = cp.concatenate([cp.nonzero(cp.diff(y_prob))[0], cp.asarray([y_prob.size - 1])])
+        # Accumulate in float64 - a float32 sum stops counting past 2^24 positives
+        tps = cp.cumsum(y_true, dtype = cp.float64)[idx]
+        fps = idx + 1 - tps
+        tpr = cp.concatenate([cp.zeros(1), tps / tps[-1]])
+        fpr = cp.concatenate([cp.zeros(1), fps / fps[-1]])
+        # Trapezoidal integration
+        roc_auc = float(((fpr[1:] - fpr[:-1]) * (tpr[1:] + tpr[:-1])).sum() / 2)
+
+    # Plot at most ~max_points, the PDF is vector output anyway
+    stride = max(1, len(fpr)//max_points)
+    fpr = np.append(host(fpr[::stride]), float(fpr[-1]))
+    tpr = np.append(host(tpr[::stride]), float(tpr[-1]))
+
+    return fpr, tpr, roc_auc
 
-    # Compute ROC curve, integrate
-    fpr, tpr, thresholds = roc_curve(y_true, y_pred)
-    roc_auc = auc(fpr, tpr)
+def plot_ROC_curve(y_true, y_pred, meta = ''):
+    fpr, tpr, roc_auc = roc_curve_points(y_true, y_pred)
 
     plt.figure()
     plt.axes([.1,.1,.8,.7])
@@ -182,22 +475,48 @@ def plot_ROC_curve(y_true, y_pred, meta = ''):
     plt.xlabel(r'$\mathrm{False \;Positive \;Rate}$')
     plt.ylabel(r'$\mathrm{True \;Positive \;Rate}$')
     plt.legend(loc="lower right")
-    plt.savefig(os.path.join('graphs', 'pi0veto_ROC.pdf'), format='pdf', dpi=1000)
+    plt.savefig(os.path.join('graphs', 'pi0veto_ROC.pdf'), format='pdf', dpi=150, bbox_inches='tight')
     plt.gcf().clear()
 
-def diagnostics(dTest, bst, hp, identifier):
-    xgb_pred = bst.predict(dTest)
-    y_pred = np.greater(xgb_pred, 0.5)
-    y_true = dTest.get_label()
-    #y_true = df_y_test.values
-
-    test_accuracy = np.equal(y_pred, y_true).mean()
+def accuracy(y_prob, y_true, cut = 0.5):
+    # Fraction of correct predictions at threshold <cut>
+    if not isinstance(y_prob, np.ndarray):
+        # Device predictions, compare against labels on the GPU
+        import cupy as cp
+        return float(((y_prob > cut) == (cp.asarray(y_true) > 0.5)).mean())
+    try:
+        import numexpr as ne
+        # Block-wise threshold, compare and sum without full-length temporaries
+        n_correct = ne.evaluate('sum(where((y_prob > cut) == (y_true > 0.5), 1, 0))')
+        return float(n_correct) / y_prob.size
+    except ImportError:
+        return np.mean((y_prob > cut) == y_true)
+
+def save_predictions(xgb_pred, path, chunk_size = 2**20):
+    # Writes predictions chunk-by-chunk into a memory-mapped .npy - device
+    # predictions are copied to host one chunk at a time, never in full
+    n = xgb_pred.shape[0]
+    output = np.lib.format.open_memmap(path, mode = 'w+', dtype = np.float32, shape = (n,))
+    for i in range(0, n, chunk_size):
+        chunk = xgb_pred[i:i+chunk_size]
+        output[i:i+chunk_size] = chunk if isinstance(chunk, np.ndarray) else chunk.get()
+    output.flush()
+    del output
+
+def diagnostics(dTest, bst, hp, identifier, xgb_pred, y_true = None):
+    # xgb_pred - test set predictions at the best iteration, shared from train_hyp_config
+    pred_output = os.path.join('models', '{}_test_pred.npy'.format(identifier))
+    save_predictions(xgb_pred, pred_output)
+    if y_true is None:
+        y_true = dTest.get_label()
+
+    test_accuracy = accuracy(xgb_pred, y_true)
     print('Test accuracy: {}'.format(test_accuracy))
 
     plot_ROC_curve(y_true = y_true, y_pred = xgb_pred,
             meta = r'xgb: {} - $\eta$: {}, depth: {}'.format(identifier, hp['eta'], hp['max_depth']))
     #plot_importances(bst)
-    print('Diagnostic graphs saved to graphs/')
+    print('Diagnostic graphs saved to graphs/, test predictions to {}'.format(pred_output))
 
 
 if __name__ == '__main__':
@@ -209,34 +528,57 @@ if __name__ == '__main__':
     parser.add_argument('-deep', '--deeptrees', help = 'Deeper tree config', action = 'store_true')
     parser.add_argument('-diag', '--diagnostics', help = 'Save diagnostics to file', action = 'store_true')
     parser.add_argument('-bal', '--balanced', help = 'Use scale_pos_weight over dataset', action = 'store_true')
+    parser.add_argument('-stream', '--streaming', help = 'Quantize HDF5 dataset in chunks', action = 'store_true')
+    parser.add_argument('-search', '--search', type = int, help = 'Number of hyperopt search evaluations')
+    parser.add_argument('-asha', '--asha', help = 'Search with successive halving pruning (Optuna)', action = 'store_true')
+    parser.add_argument('-p', '--parallelism', type = int, default = 1, help = 'Concurrent search trials (SparkTrials)')
     args = parser.parse_args()
-
-    print('Loading dataset from: %s with test size 0.05' %(args.data_file))
-    dTrain, dTest = load_data(args.data_file, args.id, parquet=False)
+    if args.search and args.streaming:
+        parser.error('Hyperparameter search requires saved DMatrix buffers, cannot be used with -stream')
 
     # Get hyperparameter config
     if args.randomhp:
         print('Using random hp config')
-        hp = get_hyp_config()
+        hyp_params = get_hyp_config()
     else:
         print('Using default hp config')
-        hp = hp_default_config(args.deeptrees)
+        hyp_params = hp_default_config(args.deeptrees)
+
+    print('Loading dataset from: %s with test size 0.05' %(args.data_file))
+    if args.streaming:
+        dTrain, dTest, X_test, y_test = load_data_streaming(args.data_file, max_bin = hyp_params.get('max_bin', 256))
+    else:
+        # Parquet file or Spark output directory, HDF5 otherwise
+        parquet = args.data_file.endswith('.parquet') or os.path.isdir(args.data_file)
+        dTrain, dTest, X_test, y_test = load_data(args.data_file, args.id, parquet=parquet)
 
     if args.balanced:
         num_T = dTrain.num_row()*dTrain.get_label().mean()
-        hp['scale_pos_weight'] = (dTrain.num_row()-num_T)/num_T
-        print('Balancing classes: F/T ratio: {}'.format(hp['scale_pos_weight']))
+        hyp_params['scale_pos_weight'] = (dTrain.num_row()-num_T)/num_T
+        print('Balancing classes: F/T ratio: {}'.format(hyp_params['scale_pos_weight']))
     num_boost_rounds=612
     if args.num_boost_rounds:
         num_boost_rounds=args.num_boost_rounds
 
+    if args.search:
+        # Search trials read back the DMatrix buffers written by load_data
+        train_path, test_path, _, _, _ = dmatrix_cache_paths(args.data_file, args.id, 0.05, parquet, False)
+        fixed_params = {'scale_pos_weight': hyp_params['scale_pos_weight']} if args.balanced else {}
+        search = asha_search if args.asha else hyperopt_search
+        print('Running {}: {} evaluations, parallelism {}'.format(search.__name__, args.search, args.parallelism))
+        results = search(train_path, test_path, num_boost_rounds, args.id, max_evals = args.search,
+                         parallelism = args.parallelism, fixed_params = fixed_params)
+        pprint(results[0])
+        save_results(results)
+        sys.exit(0)
+
     # Start boosting
     t0 = time.time()
     print('Boosting for {} iterations'.format(num_boost_rounds))
-    bst, results = train_hyp_config(dTrain, dTest, hyp_params = hp, num_boost_rounds = num_boost_rounds, identifier = args.id)
+    bst, results, test_pred = train_hyp_config(dTrain, dTest, hyp_params = hyp_params, num_boost_rounds = num_boost_rounds, identifier = args.id, X_test = X_test)
     save_results(results)
 
     # Generate diagnostic summary
     if args.diagnostics:
-        diagnostics(dTest, bst, hp, args.id)
+        diagnostics(dTest, bst, hyp_params, args.id, xgb_pred = test_pred, y_true = y_test)
 